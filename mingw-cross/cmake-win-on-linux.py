@@ -4,27 +4,59 @@
 # (c) 2017,2018,2019,2020,2021,2022 Axel Kohlmeyer <akohlmey@gmail.com>
 
 from __future__ import print_function
-import sys,os,shutil,glob,re,subprocess,tarfile,gzip,time,inspect
-try: from urllib.request import urlretrieve as geturl
-except: from urllib import urlretrieve as geturl
+import sys,os,shutil,glob,re,subprocess,shlex,collections,tarfile,gzip,time,inspect,multiprocessing,fcntl
+from concurrent.futures import ThreadPoolExecutor
+from shutil import which
+from urllib.request import urlopen
 
+# use only the CPUs this process is allowed to run on (taskset, cgroups, batch systems)
 try:
-    import multiprocessing
-    numcpus = multiprocessing.cpu_count()
-except:
-    numcpus = 1
+    numcpus = len(os.sched_getaffinity(0))
+except AttributeError:
+    try:
+        numcpus = multiprocessing.cpu_count()
+    except:
+        numcpus = 1
+
+# limit default parallel make on many-core hosts to avoid running out of RAM.
+# the limit can be changed with LAMMPS_MAX_BUILD_JOBS, an explicit -j flag overrides it.
+try:
+    maxcpus = int(os.environ.get('LAMMPS_MAX_BUILD_JOBS','24'))
+except ValueError:
+    maxcpus = 24
+numcpus = max(1,min(numcpus,maxcpus))
+
+# configure ccache so the LAMMPS objects fit into the cache. ccache gives environment
+# variables priority over ccache.conf, so only set those that are still at the built-in
+# default, i.e. that were neither set in the environment nor in a configuration file.
+ccache_settings = {'compression'      : ('CCACHE_COMPRESS','1'),
+                   'compression_level': ('CCACHE_COMPRESSLEVEL','5'),
+                   'max_size'         : ('CCACHE_MAXSIZE','20G'),
+                   'sloppiness'       : ('CCACHE_SLOPPINESS','time_macros,include_file_mtime,pch_defines')}
+try:
+    ccache_config = subprocess.check_output(['ccache','--show-config'],universal_newlines=True)
+except (OSError,subprocess.CalledProcessError):
+    ccache_config = ''
+for line in ccache_config.splitlines():
+    # lines look like: (default) max_size = 5.0G
+    words = line.split()
+    if len(words) > 1 and words[0] == '(default)' and words[1] in ccache_settings:
+        os.environ.setdefault(*ccache_settings[words[1]])
 
 # helper functions
 
 def error(str=None):
     if not str: print(helpmsg)
     else: print(sys.argv[0],"ERROR:",str)
-    sys.exit()
+    sys.exit(1)
+
+_TRUE = frozenset(['yes','Yes','Y','y','on','1','True','true'])
+_FALSE = frozenset(['no','No','N','n','off','0','False','false'])
 
 def getbool(arg,keyword):
-    if arg in ['yes','Yes','Y','y','on','1','True','true']:
+    if arg in _TRUE:
         return True
-    elif arg in ['no','No','N','n','off','0','False','false']:
+    elif arg in _FALSE:
         return False
     else:
         error("Unknown %s option: %s" % (keyword,arg))
@@ -33,39 +65,97 @@ def fullpath(path):
     return os.path.abspath(os.path.expanduser(path))
 
 def getexe(url,name):
-    gzname = name + ".gz"
-    geturl(url,gzname)
-    with gzip.open(gzname,'rb') as gz_in:
-      with open(name,'wb') as f_out:
-        shutil.copyfileobj(gz_in,f_out)
-    gz_in.close()
-    f_out.close()
-    os.remove(gzname)
+    # decompress while downloading, no temporary .gz file needed
+    resp = urlopen(url)
+    try:
+      with gzip.GzipFile(fileobj=resp) as gz_in:
+        with open(name,'wb') as f_out:
+          shutil.copyfileobj(gz_in,f_out,1<<20)
+    finally:
+      resp.close()
+
+def linktree(src,dst):
+    # clone a folder tree using hard links instead of copying file contents.
+    # unix2dos writes converted files to a new file, so the git checkout stays intact.
+    # fall back to copying when src and dst are on different file systems.
+    def linkfile(s,d):
+        try:
+            os.link(s,d)
+        except OSError:
+            shutil.copy2(s,d)
+    shutil.copytree(src,dst,symlinks=False,copy_function=linkfile)
+
+def runparallel(tasks,jobs):
+    # use fork explicitly, since the script is not importable as a module
+    ctx = multiprocessing.get_context('fork')
+    procs = [ctx.Process(target=task,args=(jobs,)) for task in tasks]
+    sys.stdout.flush()
+    for p in procs: p.start()
+    for p in procs: p.join()
+    for task,p in zip(tasks,procs):
+        if p.exitcode != 0:
+            error("Build step %s failed" % task.__name__)
+
+def lock(name):
+    # exclusive lock on a file, held until unlock() is called on the returned file object
+    f = open(name,'w')
+    fcntl.flock(f,fcntl.LOCK_EX)
+    return f
+
+def unlock(f):
+    fcntl.flock(f,fcntl.LOCK_UN)
+    f.close()
+
+def needs_crlf(name):
+    # a file needs converting if it has line feeds but no carriage returns and no NUL bytes
+    newline = False
+    with open(name,'rb') as f:
+        while True:
+            buf = f.read(1<<20)
+            if not buf: break
+            if b'\r' in buf or b'\0' in buf: return False
+            newline = newline or b'\n' in buf
+    return newline
+
+def argchunks(args):
+    # split a long list of command line arguments into batches that fit within ARG_MAX
+    try:
+        maxlen = os.sysconf('SC_ARG_MAX') // 2
+    except (AttributeError,ValueError):
+        maxlen = 32768
+    chunk = []
+    size = 0
+    for arg in args:
+        if chunk and size + len(arg) + 1 > maxlen:
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append(arg)
+        size += len(arg) + 1
+    if chunk: yield chunk
 
 def system(cmd):
+    # run command without a shell and stream its output. print it as it arrives
+    # in verbose mode, otherwise keep only the tail for reporting errors.
+    if not isinstance(cmd,list): cmd = shlex.split(cmd)
+    tail = collections.deque(maxlen=2000)
     try:
-        txt = subprocess.check_output(cmd,stderr=subprocess.STDOUT,shell=True)
-    except subprocess.CalledProcessError as e:
-        print("Command '%s' returned non-zero exit status" % e.cmd)
-        error(e.output.decode('UTF-8'))
-    return txt.decode('UTF-8')
-
-def which(program):
-    def is_exe(fpath):
-        return os.path.isfile(fpath) and os.access(fpath, os.X_OK)
-
-    fpath, fname = os.path.split(program)
-    if fpath:
-        if is_exe(program):
-            return program
-    else:
-        for path in os.environ["PATH"].split(os.pathsep):
-            path = path.strip('"')
-            exe_file = os.path.join(path, program)
-            if is_exe(exe_file):
-                return exe_file
-
-    return None
+        proc = subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.STDOUT,
+                                bufsize=1,universal_newlines=True,encoding='UTF-8',errors='replace')
+    except OSError as e:
+        error("Command '%s' failed to start: %s" % (" ".join(cmd),e))
+    for line in proc.stdout:
+        if verbose:
+            sys.stdout.write(line)
+            sys.stdout.flush()
+        tail.append(line)
+    proc.stdout.close()
+    status = proc.wait()
+    if status != 0:
+        # in verbose mode the output was already printed
+        if not verbose: sys.stdout.write("".join(tail))
+        error("Command '%s' failed with exit status %d" % (" ".join(cmd),status))
+    return "".join(tail)
 
 # record location and name of python script
 homedir, exename = os.path.split(os.path.abspath(inspect.getsourcefile(lambda:0)))
@@ -82,14 +172,16 @@ verbose = False
 gitdir  = os.path.join(homedir,"lammps")
 adminflag = True
 msixflag = False
+incflag = False
 
 helpmsg = """
-Usage: python %s -b <bits> -j <cpus> -p <mpi> -t <thread> -y <yes|no> -r <rev> -v <yes|no> -g <folder> -a <yes|no>
+Usage: python %s -b <bits> -j <cpus> -p <mpi> -t <thread> -y <yes|no> -r <rev> -v <yes|no> -g <folder> -a <yes|no> -i <yes|no>
 
 Flags (all flags are optional, defaults listed below):
   -b : select Windows variant (default value: %s)
     -b 32       : build for 32-bit Windows
     -b 64       : build for 64-bit Windows
+    -b both     : build for 32-bit and 64-bit Windows concurrently
   -j : set number of CPUs for parallel make (default value: %d)
     -j <num>    : set to any reasonable number or 1 for serial make
   -p : select message passing parallel build (default value: %s)
@@ -124,10 +216,14 @@ Flags (all flags are optional, defaults listed below):
     -a no       : the created installer runs without admin privilege and
                   LAMMPS is installed into the current user's appdata folder
     -a msix     : same as "no" but adjust for creating an MSIX package
+  -i : select incremental build mode (default value: %s)
+    -i yes      : keep the build folder and reuse its CMake configuration
+                  when the settings did not change, only recompile
+    -i no       : always start from an empty build folder
 
 Example:
   python %s -r release -t omp -p mpi
-""" % (exename,bitflag,numcpus,parflag,thrflag,pythonflag,guiflag,revflag,gitdir,exename)
+""" % (exename,bitflag,numcpus,parflag,thrflag,pythonflag,guiflag,revflag,gitdir,incflag,exename)
 
 # parse arguments
 
@@ -162,6 +258,8 @@ while i < argc:
         else:
             msixflag = False
             adminflag = getbool(argv[i+1],"admin")
+    elif argv[i] == '-i':
+        incflag = getbool(argv[i+1],"incremental")
     elif argv[i] == '-g':
         gitdir = fullpath(argv[i+1])
     else:
@@ -170,7 +268,7 @@ while i < argc:
     i+=2
 
 # checks
-if bitflag != '32' and bitflag != '64':
+if bitflag != '32' and bitflag != '64' and bitflag != 'both':
     error("Unsupported bitness flag %s" % bitflag)
 if parflag != 'no' and parflag != 'mpi' and parflag != 'ms':
     error("Unsupported parallel flag %s" % parflag)
@@ -186,6 +284,91 @@ rev3 = re.compile(r"^[a-f0-9]{40}$")
 if not rev1.match(revflag) and not rev2.match(revflag) and not rev3.match(revflag):
     error("Unsupported revision flag %s" % revflag)
 
+def update_checkout():
+    cwd = os.getcwd()
+    if not os.path.exists(gitdir):
+        # blobless clone, file contents are downloaded on demand during checkout
+        system("git clone --filter=blob:none https://github.com/lammps/lammps.git %s" % gitdir)
+
+    os.chdir(gitdir)
+    # only fetch the requested branch or tag if the checkout is shallow
+    shallow = system("git rev-parse --is-shallow-repository").strip() == "true"
+    if shallow and rev1.match(revflag):
+        system("git fetch --depth 1 origin %s" % revflag)
+    elif shallow and rev2.match(revflag):
+        system("git fetch --depth 1 origin tag %s" % revflag)
+    else:
+        system("git fetch origin")
+    system("git checkout %s" % revflag)
+    if revflag == "develop" or revflag == "stable" or revflag == "release" or revflag == "maintenance":
+        # the branch was just fetched, so move it to the remote state without a merge
+        system("git reset --hard origin/%s" % revflag)
+    os.chdir(cwd)
+
+# build both variants concurrently by running this script twice with half the CPUs each.
+# the git checkout is updated once here, so both builds use the same sources.
+if bitflag == 'both':
+    update_checkout()
+    os.environ['LAMMPS_CHECKOUT_DONE'] = '1'
+    args = []
+    for i in range(1,argc,2):
+        if argv[i] != '-b' and argv[i] != '-j': args += argv[i:i+2]
+    jobs = max(1,numcpus//2)
+    # write the output of each build to its own log file, so it does not get mixed up
+    procs = []
+    logs = []
+    for bits in ['32','64']:
+        cmd = [sys.executable,os.path.join(homedir,exename),'-b',bits,'-j',str(jobs)] + args
+        logname = fullpath("build-%s.log" % bits)
+        print("Running: "," ".join(cmd))
+        print("Output is written to: ",logname)
+        sys.stdout.flush()
+        logs.append(open(logname,'w'))
+        procs.append(subprocess.Popen(cmd,stdout=logs[-1],stderr=subprocess.STDOUT))
+    failed = []
+    for bits,p,log in zip(['32','64'],procs,logs):
+        if p.wait() != 0: failed.append(bits)
+        log.close()
+    if failed:
+        error("Build for %s-bit Windows failed, see %s" % (" and ".join(failed),
+              " and ".join(["build-%s.log" % bits for bits in failed])))
+    sys.exit(0)
+
+if parflag == "mpi" or parflag == "ms":
+    mpiflag = "on"
+else:
+    mpiflag = "off"
+
+if thrflag == "omp":
+    ompflag = "on"
+else:
+    ompflag = "off"
+
+# prefer Ninja over Makefiles as CMake build tool, if available
+if which('ninja'):
+    generator = " -G Ninja"
+else:
+    generator = ""
+
+# CMake command for configuring the LAMMPS build
+cmd = "mingw%s-cmake%s -D CMAKE_BUILD_TYPE=Release" % (bitflag,generator)
+cmd += " -D ADD_PKG_CONFIG_PATH=%s/mingw%s-pkgconfig" % (homedir,bitflag)
+cmd += " -C %s/mingw%s-pkgconfig/addpkg.cmake" % (homedir,bitflag)
+cmd += " -C %s/cmake/presets/mingw-cross.cmake -S %s/cmake" % (gitdir,gitdir)
+if bitflag == '64':
+  cmd += " -C %s/cmake/presets/kokkos-openmp.cmake" % gitdir
+cmd += " -DBUILD_SHARED_LIBS=on -DBUILD_MPI=%s -DBUILD_OMP=%s" % (mpiflag,ompflag)
+if parflag == 'ms':
+  cmd += " -DUSE_MSMPI=on"
+if guiflag:
+  cmd += " -DBUILD_LAMMPS_GUI=on -DQt5_DIR=/usr/x86_64-w64-mingw32/sys-root/mingw/lib/cmake/Qt5"
+cmd += " -DWITH_GZIP=on -DWITH_FFMPEG=on -DLAMMPS_EXCEPTIONS=on"
+cmd += " -DINTEL_LRT_MODE=c++11 -DBUILD_LAMMPS_SHELL=on"
+cmd += " -DCMAKE_CXX_COMPILER_LAUNCHER=ccache"
+cmd += " -DCMAKE_C_FLAGS_INIT=-pipe -DCMAKE_CXX_FLAGS_INIT=-pipe"
+cmd += " -DPKG_PLUGIN=yes -DPKG_PLUMED=yes"
+if pythonflag: cmd += " -DPKG_PYTHON=yes"
+
 # create working directory
 if adminflag:
     builddir = os.path.join(fullpath('.'),"tmp-%s-%s-%s-%s" % (bitflag,parflag,thrflag,revflag))
@@ -198,11 +381,25 @@ else:
         builddir = os.path.join(fullpath('.'),"tmp-%s-%s-%s-%s-msix" % (bitflag,parflag,thrflag,revflag))
     else:
         builddir = os.path.join(fullpath('.'),"tmp-%s-%s-%s-%s-noadmin" % (bitflag,parflag,thrflag,revflag))
-shutil.rmtree(builddir,True)
-try:
-    os.mkdir(builddir)
-except:
-    error("Cannot create temporary build folder: %s" % builddir)
+
+# reuse an existing build folder only if it was configured with the same CMake command
+cmdfile = os.path.join(builddir,"cmake-command.txt")
+incremental = False
+if incflag:
+    try:
+        with open(cmdfile,'r') as f:
+            incremental = (f.read() == cmd) and os.path.exists(os.path.join(builddir,"CMakeCache.txt"))
+    except (IOError,OSError):
+        incremental = False
+    if not incremental:
+        print("No matching configured build folder found. Doing a full build.")
+
+if not incremental:
+    shutil.rmtree(builddir,True)
+    try:
+        os.mkdir(builddir)
+    except:
+        error("Cannot create temporary build folder: %s" % builddir)
 
 # check for prerequisites and set up build environment
 if bitflag == '32':
@@ -235,62 +432,31 @@ Fortran compiler : %s
 Library archiver : %s
 """ % (revflag,bitflag,parflag,thrflag,homedir,gitdir,builddir,cc_cmd,cxx_cmd,fc_cmd,ar_cmd))
 
-# create/update git checkout
-if not os.path.exists(gitdir):
-    txt = system("git clone https://github.com/lammps/lammps.git %s" % gitdir)
-    if verbose: print(txt)
-
-os.chdir(gitdir)
-txt = system("git fetch origin")
-if verbose: print(txt)
-txt = system("git checkout %s" % revflag)
-if verbose: print(txt)
-if revflag == "develop" or revflag == "stable" or revflag == "release" or revflag == "maintenance":
-    txt = system("git pull")
-    if verbose: print(txt)
+# create/update git checkout, unless the parent process of a -b both build already did it
+if not os.environ.get('LAMMPS_CHECKOUT_DONE'):
+    update_checkout()
 
 # switch to build folder
 os.chdir(builddir)
 
-# download what is not automatically downloaded by CMake
-print("Downloading third party tools")
-url='http://download.lammps.org/thirdparty'
-print("FFMpeg")
-getexe("%s/ffmpeg-win%s.exe.gz" % (url,bitflag),"ffmpeg.exe")
-print("gzip")
-getexe("%s/gzip.exe.gz" % url,"gzip.exe")
-
-if parflag == "mpi" or parflag == "ms":
-    mpiflag = "on"
-else:
-    mpiflag = "off"
-
-if thrflag == "omp":
-    ompflag = "on"
+if incremental:
+    print("Reusing downloads and CMake configuration in %s" % builddir)
 else:
-    ompflag = "off"
-
-print("Configuring build with CMake")
-cmd = "mingw%s-cmake -D CMAKE_BUILD_TYPE=Release" % bitflag
-cmd += " -D ADD_PKG_CONFIG_PATH=%s/mingw%s-pkgconfig" % (homedir,bitflag)
-cmd += " -C %s/mingw%s-pkgconfig/addpkg.cmake" % (homedir,bitflag)
-cmd += " -C %s/cmake/presets/mingw-cross.cmake -S %s/cmake" % (gitdir,gitdir)
-if bitflag == '64':
-  cmd += " -C %s/cmake/presets/kokkos-openmp.cmake" % gitdir
-cmd += " -DBUILD_SHARED_LIBS=on -DBUILD_MPI=%s -DBUILD_OMP=%s" % (mpiflag,ompflag)
-if parflag == 'ms':
-  cmd += " -DUSE_MSMPI=on"
-if guiflag:
-  cmd += " -DBUILD_LAMMPS_GUI=on -DQt5_DIR=/usr/x86_64-w64-mingw32/sys-root/mingw/lib/cmake/Qt5"
-cmd += " -DWITH_GZIP=on -DWITH_FFMPEG=on -DLAMMPS_EXCEPTIONS=on"
-cmd += " -DINTEL_LRT_MODE=c++11 -DBUILD_LAMMPS_SHELL=on"
-cmd += " -DCMAKE_CXX_COMPILER_LAUNCHER=ccache"
-cmd += " -DPKG_PLUGIN=yes -DPKG_PLUMED=yes"
-if pythonflag: cmd += " -DPKG_PYTHON=yes"
-
-print("Running: ",cmd)
-txt = system(cmd)
-if verbose: print(txt)
+    # download what is not automatically downloaded by CMake
+    print("Downloading third party tools")
+    url='http://download.lammps.org/thirdparty'
+    downloads = [("%s/ffmpeg-win%s.exe.gz" % (url,bitflag),"ffmpeg.exe"),
+                 ("%s/gzip.exe.gz" % url,"gzip.exe")]
+    print(" ".join([name for url,name in downloads]))
+    # downloads are independent and I/O bound, so fetch them concurrently
+    with ThreadPoolExecutor(max_workers=len(downloads)) as pool:
+        list(pool.map(lambda args: getexe(*args), downloads))
+
+    print("Configuring build with CMake")
+    print("Running: ",cmd)
+    system(cmd)
+    with open(cmdfile,'w') as f:
+        f.write(cmd)
 
 # create qt.conf file
 if guiflag:
@@ -299,95 +465,142 @@ if guiflag:
     qtconf.close()
 
 print("Compiling")
-system("cmake --build . --parallel 8")
-print("Done")
-
-print("Configuring demo plugin build with CMake")
-cmd = "mingw%s-cmake -D CMAKE_BUILD_TYPE=Release" % bitflag
-cmd += " -S %s/examples/plugins -B plugins" % gitdir
-cmd += " -DBUILD_SHARED_LIBS=on -DBUILD_MPI=%s -DBUILD_OMP=%s" % (mpiflag,ompflag)
-if parflag == 'ms': cmd += " -DUSE_MSMPI=on"
-cmd += " -DCMAKE_CXX_COMPILER_LAUNCHER=ccache"
-
-print("Running: ",cmd)
-txt = system(cmd)
-if verbose: print(txt)
-
-print("Compiling")
-txt = system("cmake --build plugins")
-if verbose: print(txt)
+system("cmake --build . --parallel %d" % numcpus)
 print("Done")
 
+def build_demo_plugin(jobs):
+    print("Configuring demo plugin build with CMake")
+    cmd = "mingw%s-cmake%s -D CMAKE_BUILD_TYPE=Release" % (bitflag,generator)
+    cmd += " -S %s/examples/plugins -B plugins" % gitdir
+    cmd += " -DBUILD_SHARED_LIBS=on -DBUILD_MPI=%s -DBUILD_OMP=%s" % (mpiflag,ompflag)
+    if parflag == 'ms': cmd += " -DUSE_MSMPI=on"
+    cmd += " -DCMAKE_CXX_COMPILER_LAUNCHER=ccache"
+
+    print("Running: ",cmd)
+    system(cmd)
+
+    print("Compiling demo plugin")
+    system("cmake --build plugins --parallel %d" % jobs)
+    print("Done with demo plugin")
+
+def build_pace_and_collection(jobs):
+    print("Configuring pace plugin build with CMake")
+    cmd = "mingw%s-cmake%s -D CMAKE_BUILD_TYPE=Release" % (bitflag,generator)
+    cmd += " -S %s/examples/PACKAGES/pace/plugin -B paceplugin" % gitdir
+    cmd += " -DBUILD_SHARED_LIBS=on -DBUILD_MPI=%s -DBUILD_OMP=%s" % (mpiflag,ompflag)
+    cmd += " -DCMAKE_CXX_COMPILER_LAUNCHER=ccache -DLAMMPS_SOURCE_DIR=%s/src" % gitdir
+    if parflag == 'ms': cmd += " -DUSE_MSMPI=on"
+
+    print("Running: ",cmd)
+    system(cmd)
+
+    print("Compiling and building pace plugin installer")
+    system("cmake --build paceplugin --target package --parallel %d" % jobs)
+    for exe in glob.glob('paceplugin/LAMMPS*plugin*.exe'):
+        shutil.move(exe,os.path.join('..',os.path.basename(exe)))
+    print("Done with pace plugin")
+
+    print("Cloning lammps-plugin package")
+    shutil.rmtree("lammps-plugins",True)
+    system("git clone -b %s --depth 1 git@github.com:lammps/lammps-plugins.git" % revflag)
+    print("Configuring LAMMPS plugin collection build with CMake")
+    cmd = "mingw%s-cmake%s -D CMAKE_BUILD_TYPE=Release" % (bitflag,generator)
+    cmd += " -S lammps-plugins -B build_plugins"
+    cmd += " -DBUILD_SHARED_LIBS=on -DBUILD_MPI=%s -DBUILD_OMP=%s" % (mpiflag,ompflag)
+    cmd += " -DCMAKE_CXX_COMPILER_LAUNCHER=ccache -DLAMMPS_SOURCE_DIR=%s/src" % gitdir
+    if parflag == 'ms': cmd += " -DUSE_MSMPI=on"
+
+    print("Running: ",cmd)
+    system(cmd)
+
+    print("Compiling and building plugin collection installer")
+    system("cmake --build build_plugins --target package --parallel %d" % jobs)
+    for exe in glob.glob('build_plugins/LAMMPS*plugin*.exe'):
+        shutil.move(exe,os.path.join('..',os.path.basename(exe)))
+    print("Done with plugin collection")
+
+def build_manual(jobs):
+    # with -b both, only one of the two builds at a time may run make pdf in the
+    # shared doc folder. the lock file is kept inside the git folder of the checkout.
+    if not os.environ.get('LAMMPS_CHECKOUT_DONE'):
+        make_manual(jobs)
+        return
+    lockdir = system("git -C %s rev-parse --absolute-git-dir" % gitdir).strip()
+    doclock = lock(os.path.join(lockdir,"lammps-manual.lock"))
+    try:
+        make_manual(jobs)
+    finally:
+        unlock(doclock)
+
+# number of PDF manuals kept in the cache folder
+maxmanuals = 5
+
+def make_manual(jobs):
+    # reuse a previously built manual for the same LAMMPS commit. the manual also
+    # depends on files in src (API docs via doxygen, version.h), so doc alone is not enough.
+    sha = system("git -C %s rev-parse HEAD" % gitdir).strip()
+    cachedir = fullpath(os.path.join(os.environ.get('XDG_CACHE_HOME','~/.cache'),"lammps-manual"))
+    cachepdf = os.path.join(cachedir,"%s.pdf" % sha)
+    if os.path.exists(cachepdf):
+        print("Using cached PDF manual %s" % cachepdf)
+        shutil.copy(cachepdf,os.path.join(builddir,"LAMMPS-Manual.pdf"))
+        # mark as recently used, so it is not pruned from the cache
+        try:
+            os.utime(cachepdf,None)
+        except OSError:
+            pass
+        return
+
+    print("Building PDF manual")
+    os.chdir(os.path.join(gitdir,"doc"))
+    system("make -j%d pdf" % jobs)
+    try:
+        if not os.path.isdir(cachedir): os.makedirs(cachedir)
+        shutil.copy("Manual.pdf",cachepdf + ".tmp")
+        os.rename(cachepdf + ".tmp",cachepdf)
+        # keep only the most recently built manuals
+        pdfs = sorted(glob.glob(os.path.join(cachedir,"*.pdf")),key=os.path.getmtime,reverse=True)
+        for old in pdfs[maxmanuals:]:
+            os.remove(old)
+    except (IOError,OSError):
+        print("Cannot store PDF manual in cache folder %s" % cachedir)
+    shutil.move("Manual.pdf",os.path.join(builddir,"LAMMPS-Manual.pdf"))
+    print("Done with PDF manual")
+
+# the plugin builds and the manual are independent of each other, so run
+# them concurrently and split the available CPUs between them
+tasks = [build_demo_plugin]
 if not adminflag and not pythonflag and not msixflag and not guiflag:
-  print("Configuring pace plugin build with CMake")
-  cmd = "mingw%s-cmake -D CMAKE_BUILD_TYPE=Release" % bitflag
-  cmd += " -S %s/examples/PACKAGES/pace/plugin -B paceplugin" % gitdir
-  cmd += " -DBUILD_SHARED_LIBS=on -DBUILD_MPI=%s -DBUILD_OMP=%s" % (mpiflag,ompflag)
-  cmd += " -DCMAKE_CXX_COMPILER_LAUNCHER=ccache -DLAMMPS_SOURCE_DIR=%s/src" % gitdir
-  if parflag == 'ms': cmd += " -DUSE_MSMPI=on"
-
-  print("Running: ",cmd)
-  txt = system(cmd)
-  if verbose: print(txt)
-  print("Done")
-
-  print("Compiling and building installer")
-  txt = system("cmake --build paceplugin --target package")
-  if verbose: print(txt)
-  for exe in glob.glob('paceplugin/LAMMPS*plugin*.exe'):
-    shutil.move(exe,os.path.join('..',os.path.basename(exe)))
-  print("Done")
-
-  print("Cloning lammps-plugin package")
-  txt = system("git clone -b %s --depth 1 git@github.com:lammps/lammps-plugins.git" % revflag)
-  if verbose: print(txt)
-  print("Configuring LAMMPS plugin collection build with CMake")
-  cmd = "mingw%s-cmake -D CMAKE_BUILD_TYPE=Release" % bitflag
-  cmd += " -S lammps-plugins -B build_plugins"
-  cmd += " -DBUILD_SHARED_LIBS=on -DBUILD_MPI=%s -DBUILD_OMP=%s" % (mpiflag,ompflag)
-  cmd += " -DCMAKE_CXX_COMPILER_LAUNCHER=ccache -DLAMMPS_SOURCE_DIR=%s/src" % gitdir
-  if parflag == 'ms': cmd += " -DUSE_MSMPI=on"
-
-  print("Running: ",cmd)
-  txt = system(cmd)
-  if verbose: print(txt)
-  print("Done")
-
-  print("Compiling and building installer")
-  txt = system("cmake --build build_plugins --target package")
-  if verbose: print(txt)
-  for exe in glob.glob('build_plugins/LAMMPS*plugin*.exe'):
-    shutil.move(exe,os.path.join('..',os.path.basename(exe)))
-  print("Done")
-
-print("Building PDF manual")
-os.chdir(os.path.join(gitdir,"doc"))
-txt = system("make pdf")
-if verbose: print(txt)
-shutil.move("Manual.pdf",os.path.join(builddir,"LAMMPS-Manual.pdf"))
-print("Done")
+    tasks.append(build_pace_and_collection)
+tasks.append(build_manual)
+runparallel(tasks,max(1,numcpus//len(tasks)))
 
 # switch back to build folder and copy/process files for inclusion in installer
 print("Collect and convert files for the Installer package")
 os.chdir(builddir)
-shutil.copytree(os.path.join(gitdir,"examples"),os.path.join(builddir,"examples"),symlinks=False)
-shutil.copytree(os.path.join(gitdir,"bench"),os.path.join(builddir,"bench"),symlinks=False)
-shutil.copytree(os.path.join(gitdir,"tools"),os.path.join(builddir,"tools"),symlinks=False)
-shutil.copytree(os.path.join(gitdir,"python","lammps"),os.path.join(builddir,"python","lammps"),symlinks=False)
-shutil.copytree(os.path.join(gitdir,"potentials"),os.path.join(builddir,"potentials"),symlinks=False)
+for d in ['examples','bench','tools','python','potentials']:
+    shutil.rmtree(d,True)
+linktree(os.path.join(gitdir,"examples"),os.path.join(builddir,"examples"))
+linktree(os.path.join(gitdir,"bench"),os.path.join(builddir,"bench"))
+linktree(os.path.join(gitdir,"tools"),os.path.join(builddir,"tools"))
+linktree(os.path.join(gitdir,"python","lammps"),os.path.join(builddir,"python","lammps"))
+linktree(os.path.join(gitdir,"potentials"),os.path.join(builddir,"potentials"))
 shutil.copy(os.path.join(gitdir,"README"),os.path.join(builddir,"README.txt"))
 shutil.copy(os.path.join(gitdir,"LICENSE"),os.path.join(builddir,"LICENSE.txt"))
-shutil.copy(os.path.join(gitdir,"doc","src","PDF","colvars-refman-lammps.pdf"),os.path.join(builddir,"Colvars-Manual.pdf"))
-shutil.copy(os.path.join(gitdir,"tools","createatoms","Manual.pdf"),os.path.join(builddir,"CreateAtoms-Manual.pdf"))
-shutil.copy(os.path.join(gitdir,"doc","src","PDF","kspace.pdf"),os.path.join(builddir,"Kspace-Extra-Info.pdf"))
-shutil.copy(os.path.join(gitdir,"doc","src","PDF","pair_gayberne_extra.pdf"),os.path.join(builddir,"PairGayBerne-Manual.pdf"))
-shutil.copy(os.path.join(gitdir,"doc","src","PDF","pair_resquared_extra.pdf"),os.path.join(builddir,"PairReSquared-Manual.pdf"))
-shutil.copy(os.path.join(gitdir,"doc","src","PDF","PDLammps_overview.pdf"),os.path.join(builddir,"PDLAMMPS-Overview.pdf"))
-shutil.copy(os.path.join(gitdir,"doc","src","PDF","PDLammps_EPS.pdf"),os.path.join(builddir,"PDLAMMPS-EPS.pdf"))
-shutil.copy(os.path.join(gitdir,"doc","src","PDF","PDLammps_VES.pdf"),os.path.join(builddir,"PDLAMMPS-VES.pdf"))
-shutil.copy(os.path.join(gitdir,"doc","src","PDF","SPH_LAMMPS_userguide.pdf"),os.path.join(builddir,"SPH-Manual.pdf"))
-shutil.copy(os.path.join(gitdir,"doc","src","PDF","MACHDYN_LAMMPS_userguide.pdf"),os.path.join(builddir,"MACHDYN-Manual.pdf"))
-shutil.copy(os.path.join(gitdir,"doc","src","PDF","CG-DNA.pdf"),os.path.join(builddir,"CG-DNA-Manual.pdf"))
+pdfdir = os.path.join(gitdir,"doc","src","PDF")
+pdfs = [(os.path.join(pdfdir,"colvars-refman-lammps.pdf"),"Colvars-Manual.pdf"),
+        (os.path.join(gitdir,"tools","createatoms","Manual.pdf"),"CreateAtoms-Manual.pdf"),
+        (os.path.join(pdfdir,"kspace.pdf"),"Kspace-Extra-Info.pdf"),
+        (os.path.join(pdfdir,"pair_gayberne_extra.pdf"),"PairGayBerne-Manual.pdf"),
+        (os.path.join(pdfdir,"pair_resquared_extra.pdf"),"PairReSquared-Manual.pdf"),
+        (os.path.join(pdfdir,"PDLammps_overview.pdf"),"PDLAMMPS-Overview.pdf"),
+        (os.path.join(pdfdir,"PDLammps_EPS.pdf"),"PDLAMMPS-EPS.pdf"),
+        (os.path.join(pdfdir,"PDLammps_VES.pdf"),"PDLAMMPS-VES.pdf"),
+        (os.path.join(pdfdir,"SPH_LAMMPS_userguide.pdf"),"SPH-Manual.pdf"),
+        (os.path.join(pdfdir,"MACHDYN_LAMMPS_userguide.pdf"),"MACHDYN-Manual.pdf"),
+        (os.path.join(pdfdir,"CG-DNA.pdf"),"CG-DNA-Manual.pdf")]
+for src,dst in pdfs:
+    shutil.copyfile(src,os.path.join(builddir,dst))
 
 # prune outdated inputs, too large files, or examples of packages we don't bundle
 for d in ['accelerate','kim','mscg','PACKAGES/quip','PACKAGES/vtk']:
@@ -404,17 +617,36 @@ if os.path.exists("examples/PACKAGES/mesont/C_10_10.mesocnt"):
 if os.path.exists("examples/PACKAGES/mesont/TABTP_10_10.mesont"):
     os.remove("examples/PACKAGES/mesont/TABTP_10_10.mesont")
 
-# convert text files to CR-LF conventions
-txt = system("unix2dos LICENSE.txt README.txt tools/msi2lmp/README")
-if verbose: print(txt)
-txt = system("find bench examples potentials python tools/msi2lmp/frc_files -type f -print | xargs unix2dos")
-if verbose: print(txt)
-# mass rename README to README.txt
-txt = system('for f in $(find tools bench examples potentials python -name README -print); do  mv -v $f $f.txt; done')
-if verbose: print(txt)
-# mass rename in.<name> to in.<name>.lmp
-txt = system('for f in $(find bench examples -name in.\* -print); do  mv -v $f $f.lmp; done')
-if verbose: print(txt)
+# collect text files to convert to CR-LF conventions and files to rename in a single pass:
+# - README files are renamed to README.txt
+# - LAMMPS inputs in.<name> are renamed to in.<name>.lmp
+to_convert = ['LICENSE.txt','README.txt','tools/msi2lmp/README.txt']
+readme_renames = []
+in_renames = []
+for top in ['tools','bench','examples','potentials','python']:
+    for root, dirs, files in os.walk(top):
+        convert = (top != 'tools') or (root == 'tools/msi2lmp/frc_files') \
+            or root.startswith('tools/msi2lmp/frc_files/')
+        for f in files:
+            path = os.path.join(root,f)
+            if f == 'README':
+                readme_renames.append(path)
+                path += '.txt'
+            elif f.startswith('in.') and top in ['bench','examples']:
+                in_renames.append(path)
+                path += '.lmp'
+            if convert: to_convert.append(path)
+
+for f in readme_renames:
+    os.rename(f,f + '.txt')
+    if verbose: print("renamed '%s' -> '%s.txt'" % (f,f))
+for f in in_renames:
+    os.rename(f,f + '.lmp')
+    if verbose: print("renamed '%s' -> '%s.lmp'" % (f,f))
+# skip files that already have CR-LF line endings or are binary
+to_convert = [f for f in to_convert if needs_crlf(f)]
+for chunk in argchunks(to_convert):
+    system(['unix2dos'] + chunk)
 print("Done")
 
 print("Configuring and building installer")
@@ -445,9 +677,9 @@ shutil.copy(os.path.join(homedir,"installer","lammps-text-logo-wide.bmp"),os.pat
 version = revflag
 if revflag == 'stable' or revflag == 'release' or rev2.match(revflag):
   with open(os.path.join(gitdir,"src","version.h"),'r') as v_file:
-    verexp = re.compile(r'^.*"(\w+) (\w+) (\w+)".*$')
+    # first line is: #define LAMMPS_VERSION "DD Mon YYYY"
     vertxt = v_file.readline()
-    verseq = verexp.match(vertxt).groups()
+    verseq = vertxt.split('"',2)[1].split()
     version = "".join(verseq)
 elif revflag == 'develop' or revflag == 'maintenance':
     version = time.strftime('%Y-%m-%d')
@@ -458,19 +690,19 @@ elif bitflag == '64':
     mingwdir = '/usr/x86_64-w64-mingw32/sys-root/mingw/bin/'
 
 if parflag == 'mpi':
-    txt = system("makensis -DMINGW=%s -DVERSION=%s-MPI -DBIT=%s -DLMPREV=%s lammps.nsis" % (mingwdir,version,bitflag,revflag))
-    if verbose: print(txt)
+    system("makensis -DMINGW=%s -DVERSION=%s-MPI -DBIT=%s -DLMPREV=%s lammps.nsis" % (mingwdir,version,bitflag,revflag))
 elif parflag == 'ms':
-    txt = system("makensis -DMINGW=%s -DVERSION=%s-MSMPI -DBIT=%s -DLMPREV=%s lammps.nsis" % (mingwdir,version,bitflag,revflag))
-    if verbose: print(txt)
+    system("makensis -DMINGW=%s -DVERSION=%s-MSMPI -DBIT=%s -DLMPREV=%s lammps.nsis" % (mingwdir,version,bitflag,revflag))
 else:
-    txt = system("makensis -DMINGW=%s -DVERSION=%s -DBIT=%s -DLMPREV=%s lammps.nsis" % (mingwdir,version,bitflag,revflag))
-    if verbose: print(txt)
+    system("makensis -DMINGW=%s -DVERSION=%s -DBIT=%s -DLMPREV=%s lammps.nsis" % (mingwdir,version,bitflag,revflag))
 
 # clean up after successful build
 os.chdir('..')
 
-print("Cleaning up...")
-shutil.rmtree(builddir,True)
+if incflag:
+    print("Keeping build folder %s for incremental builds" % builddir)
+else:
+    print("Cleaning up...")
+    shutil.rmtree(builddir,True)
 print("Done.")
 